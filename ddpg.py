@@ -6,24 +6,28 @@ import argparse
 import numpy as np
 import os
 import threading
+import multiprocessing
 
-from utils import save, load, AgentBase
+from utils import save, load, initialize_uninitialized, AgentBase
 
 """ ======= DISTRIBUTED DEEP DETERMINISTIC POLICY GRADIENT IMPLEMENTATION =======
 1. For better exploration, the behavior policy in DDPG contains noise 
    generated by Ornstein-Uhlenbeck process, i.e. exponential decay
    
-2. Update both policy and Q function using exponential moving average 
-   instead of using `tf.assign`
+2. Update both target policy and target Q function with a Polyak
+   average `target <- (1 - TAU) * target + TAU * online`, grouped into
+   a single op
 
 3. Observe that both rolling event and updating the model 
-   requires only the interaction with the buffer, thus uses 
-   multi-threads to implement the algorithm
+   requires only the interaction with the buffer, thus runs the 
+   rollout in a separate process sharing the buffer memory, so 
+   neither side is serialized by the GIL
 
 =============================== GLOBAL VARIABLES =========================== """
 GAMMA = 0.9
 TAU = 0.01
 VAR_DECAY = 0.995
+OU_THETA = 0.15
 A_LR = 1e-3
 C_LR = 2e-3
 A_ITER = 3
@@ -35,169 +39,469 @@ BATCH_SIZE = 128
 EP_MAXLEN = 200
 N_ITERS = 9000
 CAPACITY = 10000
+N_ENVS = 8
+N_INIT_ENVS = 32
+INDEX_BLOCKS = 1024
+PREFETCH = 4
+SCRATCH_SLOTS = 2 * PREFETCH + 2
+SYNC_EVERY = 10
 WRITE_LOGS_EVERY = 200
 LOGDIR = './logs/ddpg/'
 MODEL_DIR = './ckpt/ddpg/'
 
 RENDER = True
 TEST = True
-LOCK = threading.Lock()
+MIXED_PRECISION = True
+COMPUTE_DTYPE = tf.float16 if MIXED_PRECISION else tf.float32
 
 """ ========================================================================= """
 
-class EMAGetter(object):
-    ema = tf.train.ExponentialMovingAverage(decay=1.0 - TAU)
-
-    def __call__(self, getter, name, *args, **kwargs):
-        return self.ema.average(getter(name, *args, **kwargs))
+def fp32_storage_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    """Keeps every variable in FP32 and hands a cast copy to layers computing in another dtype"""
+    variable = getter(name, *args, shape=shape, dtype=tf.float32, **kwargs)
+    if dtype is not None and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
 
 
 class MemoryBuffer(object):
-    def __init__(self, capacity, s_dim, a_dim):
+    def __init__(self, capacity, s_dim, a_dim, batch_size=BATCH_SIZE):
         self.capacity = capacity
-        self.state = np.zeros((capacity, s_dim), dtype=np.float32)
-        self.action = np.zeros((capacity, a_dim), dtype=np.float32)
-        self.reward = np.zeros((capacity, 1), dtype=np.float32)
-        self.s_next = np.zeros((capacity, s_dim), dtype=np.float32)
-        self.pointer = 0
-
-    def init_buffer(self, env, agent):
+        # Shared with the rollout process, pickling re-attaches to the same arrays
+        self._shapes = {'state': (capacity, s_dim), 'action': (capacity, a_dim),
+                        'reward': (capacity, 1), 's_next': (capacity, s_dim)}
+        self._raw = {key: multiprocessing.RawArray('f', int(np.prod(shape)))
+                     for key, shape in self._shapes.items()}
+        self._pointer = multiprocessing.Value('i', 0, lock=False)
+        self._full = multiprocessing.Value('b', False, lock=False)
+        self._attach()
+        self._rng = np.random.default_rng()
+        self._index_cache = np.zeros((INDEX_BLOCKS, batch_size), dtype=np.int32)
+        self._cache_ptr = INDEX_BLOCKS
+        self._scratch = None
+        self._scratch_ptr = 0
+
+    def _attach(self):
+        for key, raw in self._raw.items():
+            setattr(self, key, np.frombuffer(raw, dtype=np.float32).reshape(self._shapes[key]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self._shapes:
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    @property
+    def pointer(self):
+        return self._pointer.value
+
+    @pointer.setter
+    def pointer(self, value):
+        self._pointer.value = value
+
+    @property
+    def full(self):
+        return bool(self._full.value)
+
+    @full.setter
+    def full(self, value):
+        self._full.value = value
+
+    def init_buffer(self, envs):
+        """init_buffer
+        :param envs: type gym.vector.VectorEnv
+
+        Fills the buffer once with uniformly random actions, the untrained policy
+        is essentially noise anyway, so no inference is needed
+        """
+        n, a_dim = envs.num_envs, self.action.shape[1]
         while True:
-            s = env.reset()
+            s = envs.reset().astype(np.float32)
             for it in range(EP_MAXLEN):
-                a = agent.choose_action(s)
-                s_next, r, done, info = env.step(a)
+                a = self._rng.uniform(-2.0, 2.0, size=(n, a_dim)).astype(np.float32)
+                s_next, r, done, info = envs.step(a)
+                s_next = s_next.astype(np.float32)
                 r = (r + 8.0) / 8.0
-                self.store_transition(s, a, r, s_next)
-                if self.pointer == 0:
+                self.store_batch(s, a, r, s_next)
+                if self.full:
                     return
-                if done:
-                    break
-
-    def store_transition(self, s, a, r, s_next):
-        self.state[self.pointer, :] = s
-        self.action[self.pointer, :] = a
-        self.reward[self.pointer, :] = r
-        self.s_next[self.pointer, :] = s_next
-        self.pointer = (self.pointer + 1) % self.capacity
+                s = s_next
+
+    def store_batch(self, s, a, r, s_next):
+        p, n = self.pointer, s.shape[0]
+        if p + n <= self.capacity:
+            np.copyto(self.state[p:p + n], s, casting='unsafe')
+            np.copyto(self.action[p:p + n], a, casting='unsafe')
+            np.copyto(self.reward[p:p + n, 0], r, casting='unsafe')
+            np.copyto(self.s_next[p:p + n], s_next, casting='unsafe')
+        else:
+            indices = np.arange(p, p + n) % self.capacity
+            self.state[indices] = s
+            self.action[indices] = a
+            self.reward[indices, 0] = r
+            self.s_next[indices] = s_next
+        # Single producer: the rows are complete before the pointer moves past them
+        if p + n >= self.capacity:
+            self.full = True
+        self.pointer = (p + n) % self.capacity
 
     def sample(self, num):
-        indices = np.random.randint(0, self.capacity, size=[num])
-        return self.state[indices], self.action[indices], self.reward[indices], self.s_next[indices]
+        # Single consumer: a stale pointer or a torn row is harmless here
+        if self.full and num == self._index_cache.shape[1]:
+            if self._cache_ptr == INDEX_BLOCKS:
+                self._index_cache = self._rng.integers(0, self.capacity, size=self._index_cache.shape,
+                                                       dtype=np.int32)
+                self._cache_ptr = 0
+            indices = self._index_cache[self._cache_ptr]
+            self._cache_ptr += 1
+        else:
+            size = self.capacity if self.full else self.pointer
+            indices = self._rng.integers(0, size, size=num, dtype=np.int32)
+        fields = (self.state, self.action, self.reward, self.s_next)
+        if num != self._index_cache.shape[1]:
+            return tuple(arr.take(indices, axis=0) for arr in fields)
+        if self._scratch is None:
+            self._scratch = [tuple(np.empty((num,) + arr.shape[1:], dtype=np.float32) for arr in fields)
+                             for _ in range(SCRATCH_SLOTS)]
+        # More slots than batches the input pipeline keeps alive
+        batch = self._scratch[self._scratch_ptr]
+        self._scratch_ptr = (self._scratch_ptr + 1) % SCRATCH_SLOTS
+        for arr, out in zip(fields, batch):
+            np.take(arr, indices, axis=0, out=out)
+        return batch
 
 
 
 class DDPGModel(AgentBase):
     name = 'DDPGModel'
 
-    def __init__(self, s_dim, a_dim):
-        self.state = tf.placeholder(tf.float32, [None, s_dim], name='state')
-        self.s_next = tf.placeholder(tf.float32, [None, s_dim], name='s_next')
-        self.reward = tf.placeholder(tf.float32, [None, 1], name='discounted_r')
+    def __init__(self, s_dim, a_dim, buffer=None, model_path=None):
+        """__init__
+        :param buffer: type MemoryBuffer, when given the training inputs are pulled from it
+            by a prefetching tf.data pipeline, without it the model is inference-only
+        :param model_path: type str, checkpoint directory restored before initialization
+        """
+        self.training = buffer is not None
+        if self.training:
+            self._build_input_pipeline(buffer, s_dim, a_dim)
+        else:
+            self.state = tf.placeholder(tf.float32, [None, s_dim], name='state')
 
-        self.ema_getter = EMAGetter()
         with tf.variable_scope('DDPG'):
             self.actor = self._build_policy(self.state, 'Actor', a_dim)
             self.target_q = self._build_q_network(self.state, self.actor, 'Critic')
 
         a_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='DDPG/Actor')
         c_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='DDPG/Critic')
-        target_update = [self.ema_getter.ema.apply(a_vars), self.ema_getter.ema.apply(c_vars)]
-
-        with tf.variable_scope('DDPG'):
-            self.a_next = self._build_policy(self.s_next, 'Actor', a_dim, trainable=False,
-                                             reuse=True, custom_getter=self.ema_getter)
-            self.eval_q = self._build_q_network(self.s_next, self.a_next, 'Critic', trainable=False,
-                                                reuse=True, custom_getter=self.ema_getter)
-
-        a_loss = -tf.reduce_mean(self.target_q)
-        self.a_optim = tf.train.AdamOptimizer(A_LR).minimize(a_loss, var_list=a_vars)
-
-        with tf.control_dependencies(target_update):
-            td_error = tf.losses.mean_squared_error(labels=self.reward + GAMMA * self.eval_q,
-                                                    predictions=self.target_q)
-            self.c_optim = tf.train.AdamOptimizer(C_LR).minimize(td_error, var_list=c_vars)
+        self.a_vars = a_vars
+        self._actor_params = [tf.placeholder(v.dtype.base_dtype, v.shape) for v in a_vars]
+        self._load_actor = tf.group(*[v.assign(p) for v, p in zip(a_vars, self._actor_params)])
+        self._load_feed = dict.fromkeys(self._actor_params)
+        if self.training:
+            self._build_training_graph(a_dim, a_vars, c_vars)
 
         self.counter = 0
         self.variance = 3.0
+        self._rng = np.random.default_rng(0)
+        self._ou = np.zeros(a_dim, dtype=np.float32)
+
+        config = tf.ConfigProto()
+        # Tiny networks, op launches dominate
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        self.sess = tf.Session(config=config)
+        if model_path is not None:
+            # Partial, so that EMA-era checkpoints restore without the target variables
+            _, self.counter = load(self.sess, model_path=model_path, allow_partial=True)
+        initialize_uninitialized(self.sess)
+        self._act = self.sess.make_callable(self.actor, feed_list=[self.state])
+        self._value = self.sess.make_callable(self.target_q, feed_list=[self.state])
+        if self.training:
+            self._train = self.sess.make_callable(self.train_op)
+            self._train_with_sums = self.sess.make_callable([self.train_op, self.sums])
+        print(' [*] Build DDPGModel finished...')
+
 
+    def _build_training_graph(self, a_dim, a_vars, c_vars):
+        target_a_vars = [tf.Variable(v.initialized_value(), trainable=False, use_resource=True,
+                                     name='Target/' + v.op.name) for v in a_vars]
+        target_c_vars = [tf.Variable(v.initialized_value(), trainable=False, use_resource=True,
+                                     name='Target/' + v.op.name) for v in c_vars]
+        target_update = tf.group(*[tv.assign(tv * (1.0 - TAU) + v * TAU) for v, tv in
+                                   zip(a_vars + c_vars, target_a_vars + target_c_vars)], name='polyak_update')
+
+        with tf.control_dependencies([target_update]), tf.name_scope('Target'):
+            self.a_next = self._target_policy(self.s_next, target_a_vars)
+            self.eval_q = self._target_q_network(self.s_next, self.a_next, target_c_vars)
+
+        def critic_loss():
+            # Q(s, a) and the TD loss share one XLA cluster
+            with tf.xla.experimental.jit_scope():
+                with tf.variable_scope('DDPG'):
+                    q = self._build_q_network(self.state, self.action, 'Critic', reuse=True)
+                diff = self.reward + GAMMA * self.eval_q - q
+                return tf.reduce_mean(diff * diff)
+
+        with tf.control_dependencies([target_update]):
+            self.c_optim, td_error = self._build_unrolled_update(
+                critic_loss, self._build_optimizer(C_LR), c_vars, C_ITER)
+
+        actor_q = []
+
+        def actor_loss():
+            with tf.variable_scope('DDPG'):
+                action = self._build_policy(self.state, 'Actor', a_dim, reuse=True)
+                q = self._build_q_network(self.state, action, 'Critic', reuse=True)
+            actor_q.append(q)
+            return -tf.reduce_mean(q)
+
+        with tf.control_dependencies([self.c_optim]):
+            self.a_optim, a_loss = self._build_unrolled_update(
+                actor_loss, self._build_optimizer(A_LR), a_vars, A_ITER)
+        self.train_op = tf.group(self.c_optim, self.a_optim, name='train_op')
+
+        # Read inside the update chain, `target_q` is unordered against `train_op`
         self.sums = tf.summary.merge([
             tf.summary.scalar('reward', tf.reduce_mean(self.reward)),
             tf.summary.scalar('actor_loss', a_loss),
             tf.summary.scalar('critic_loss', td_error),
-            tf.summary.histogram('Q_taregt', self.target_q)
+            tf.summary.histogram('Q_taregt', actor_q[0])
         ], name='summaries')
 
-        self.sess = tf.Session()
-        self.sess.run(tf.global_variables_initializer())
-        print(' [*] Build DDPGModel finished...')
-
 
-    def _build_policy(self, state, scope, a_dim, trainable=True, reuse=False, custom_getter=None):
-        with tf.variable_scope(scope, reuse=reuse, custom_getter=custom_getter):
-            net = tf.layers.dense(state, 64, activation=tf.nn.relu, trainable=trainable, name='h1')
-            action = 2.0 * tf.layers.dense(net, a_dim, activation=tf.nn.tanh, trainable=trainable, name='h2')
+    def _build_input_pipeline(self, buffer, s_dim, a_dim, prefetch=PREFETCH):
+        dataset = tf.data.Dataset.from_generator(
+            lambda: iter(lambda: buffer.sample(BATCH_SIZE), None),
+            output_types=(tf.float32,) * 4,
+            output_shapes=([BATCH_SIZE, s_dim], [BATCH_SIZE, a_dim], [BATCH_SIZE, 1], [BATCH_SIZE, s_dim]))
+        s, a, r, s_next = dataset.prefetch(prefetch).make_one_shot_iterator().get_next()
+        # Inference still feeds `state`, which then bypasses the iterator
+        self.state = tf.placeholder_with_default(s, [None, s_dim], name='state')
+        self.action = tf.placeholder_with_default(a, [None, a_dim], name='action')
+        self.s_next = tf.placeholder_with_default(s_next, [None, s_dim], name='s_next')
+        self.reward = tf.placeholder_with_default(r, [None, 1], name='discounted_r')
+
+
+    def _build_policy(self, state, scope, a_dim, reuse=False):
+        with tf.variable_scope(scope, reuse=reuse, use_resource=True, custom_getter=fp32_storage_getter), \
+                tf.xla.experimental.jit_scope():
+            net = tf.layers.dense(tf.cast(state, COMPUTE_DTYPE), 64, activation=tf.nn.relu, name='h1')
+            # The tanh action head stays in FP32
+            action = 2.0 * tf.layers.dense(tf.cast(net, tf.float32), a_dim, activation=tf.nn.tanh, name='h2')
         return action
 
 
-    def _build_q_network(self, state, action, scope, trainable=True, reuse=False, custom_getter=None):
-        with tf.variable_scope(scope, reuse=reuse, custom_getter=custom_getter):
-            h1 = tf.layers.dense(state, 64, activation=None, trainable=trainable, name='h1')
-            h2 = tf.layers.dense(action, 64, activation=None, use_bias=False, trainable=trainable, name='h2')
+    def _build_q_network(self, state, action, scope, reuse=False):
+        with tf.variable_scope(scope, reuse=reuse, use_resource=True, custom_getter=fp32_storage_getter), \
+                tf.xla.experimental.jit_scope():
+            h1 = tf.layers.dense(tf.cast(state, COMPUTE_DTYPE), 64, activation=None, name='h1')
+            h2 = tf.layers.dense(tf.cast(action, COMPUTE_DTYPE), 64, activation=None, use_bias=False, name='h2')
             h3 = tf.nn.relu(h1 + h2)
-            return tf.layers.dense(h3, 1, trainable=trainable, use_bias=True, activation=None, name='h3')
-
-
-    def train(self, s, a, r, s_next, callback=None):
-        feed_dict = {self.state: s, self.actor: a, self.reward: r, self.s_next: s_next}
-        for _ in range(C_ITER):
-            self.sess.run(self.c_optim, feed_dict=feed_dict)
-        feed_dict.pop(self.actor)
-        for _ in range(A_ITER):
-            self.sess.run(self.a_optim, feed_dict=feed_dict)
+            # The Q output layer stays in FP32
+            return tf.layers.dense(tf.cast(h3, tf.float32), 1, use_bias=True, activation=None, name='h3')
+
+
+    def _target_policy(self, state, params):
+        """_target_policy
+        :param params: the target copies of the `_build_policy` variables, in creation order
+
+        Same network as `_build_policy`, read straight from the target variables
+        """
+        w1, b1, w2, b2 = params
+        with tf.xla.experimental.jit_scope():
+            net = tf.nn.relu(tf.matmul(state, w1) + b1)
+            return 2.0 * tf.nn.tanh(tf.matmul(net, w2) + b2)
+
+
+    def _target_q_network(self, state, action, params):
+        """_target_q_network
+        :param params: the target copies of the `_build_q_network` variables, in creation order
+
+        Same network as `_build_q_network`, read straight from the target variables
+        """
+        w1, b1, w2, w3, b3 = params
+        with tf.xla.experimental.jit_scope():
+            h3 = tf.nn.relu(tf.matmul(state, w1) + b1 + tf.matmul(action, w2))
+            return tf.matmul(h3, w3) + b3
+
+
+    def _build_optimizer(self, lr):
+        optimizer = tf.train.AdamOptimizer(lr)
+        if MIXED_PRECISION:
+            # Dynamic loss scaling keeps the FP16 hidden-layer gradients from underflowing
+            optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optimizer, 'dynamic')
+        return optimizer
+
+
+    def _build_unrolled_update(self, loss_fn, optimizer, var_list, n_iter):
+        """_build_unrolled_update
+        :param loss_fn: callable that builds the loss, called once per iteration
+        :param n_iter: type int, number of chained updates baked into the graph
+        :return: the op running all `n_iter` updates, and the loss of the first one
+
+        Each iteration rebuilds the loss under a control dependency on the
+        previous update, so it reads the freshly updated variables and the
+        whole loop costs a single `sess.run`
+        """
+        update, first_loss = tf.no_op(), None
+        for _ in range(n_iter):
+            with tf.control_dependencies([update]):
+                loss = loss_fn()
+                update = optimizer.minimize(loss, var_list=var_list)
+            if first_loss is None:
+                first_loss = loss
+        return update, first_loss
+
+
+    def train(self, callback=None):
+        """train
+        :param callback: called as `callback(sumstr, global_step)` every WRITE_LOGS_EVERY steps, the
+            summaries are fetched by the same run as the training step
+
+        Runs one training step on the next batch of the input pipeline, the model has to be
+        built with a buffer
+        """
+        if not self.training:
+            raise RuntimeError('An inference-only DDPGModel (built without a buffer) cannot be trained')
+        if callback is not None and self.counter % WRITE_LOGS_EVERY == 5:
+            _, sumstr = self._train_with_sums()
+            callback(sumstr, self.counter)
+        else:
+            self._train()
         self.counter += 1
         if self.counter % WRITE_LOGS_EVERY == (WRITE_LOGS_EVERY - 1):
             self.variance *= VAR_DECAY
             print('Global step {}, current variance in behavior policy {}'.format(self.counter, self.variance))
-        if callback is not None:
-            callback(self.sums, feed_dict)
 
 
     def choose_action(self, s):
-        a = self.sess.run(self.actor, feed_dict={self.state: s[None, :]})[0]
-        var = np.random.normal(0.0, self.variance, size=a.shape)
-        return np.clip(a + var, -2.0, 2.0)
+        """choose_action
+        :param s: type np.ndarray, either a single state [S_DIM] or a batch [B, S_DIM]
+        :return: the noisy action(s) with the matching leading shape
+        """
+        batch = s if s.ndim == 2 else s[None, :]
+        a = self._act(batch.astype(np.float32))
+        if self._ou.shape != a.shape:
+            self._ou = np.zeros(a.shape, dtype=np.float32)
+        # Zero-mean Ornstein-Uhlenbeck step: x <- (1 - theta) * x + sigma * N(0, 1)
+        self._ou *= 1.0 - OU_THETA
+        self._ou += self.variance * self._rng.standard_normal(a.shape, dtype=np.float32)
+        a += self._ou
+        np.clip(a, -2.0, 2.0, out=a)
+        return a if s.ndim == 2 else a[0]
 
 
     def get_value(self, s):
-        return self.sess.run(self.target_q, feed_dict={self.state: s[None, :]})
+        return self._value(s[None, :].astype(np.float32))
+
+
+    def get_actor_params(self):
+        return self.sess.run(self.a_vars)
+
+
+    def set_actor_params(self, params):
+        for param, value in zip(self._actor_params, params):
+            self._load_feed[param] = value
+        self.sess.run(self._load_actor, feed_dict=self._load_feed)
+
+
+
+def make_env():
+    return gym.make('Pendulum-v0').unwrapped
+
+
+def make_async_envs(n_envs):
+    # Forks the workers, only safe before the calling process creates a tf.Session
+    return gym.vector.AsyncVectorEnv([make_env for _ in range(n_envs)], context='fork')
+
+
+
+class BufferProcess(multiprocessing.Process):
+    """BufferProcess
+    :param buffer: type MemoryBuffer, shared with the learner process
+    :param conn: receiving end of a Pipe, carries `(actor_params, variance)` from the
+        learner, and None to stop
+
+    Rolls out its own copy of the actor, refreshed with the weights pushed by the learner
+    """
+    def __init__(self, buffer, conn, wid=1, render=True, n_envs=N_ENVS):
+        self.buffer = buffer
+        self.conn = conn
+        self.render = render
+        self.wid = wid
+        self.n_envs = n_envs
+        super(BufferProcess, self).__init__()
+        print(' [*] BufferProcess {} okay...'.format(wid))
+
+    def sync(self, model):
+        """Applies the latest pushed weights, returns False once the learner asks to stop"""
+        msg = None
+        while self.conn.poll():
+            msg = self.conn.recv()
+            if msg is None:
+                return False
+        if msg is not None:
+            params, model.variance = msg
+            model.set_actor_params(params)
+        return True
+
+    def run(self):
+        print(' [*] BufferProcess start to run...')
+        # Rendering needs direct access to the env, which only lives in-process with SyncVectorEnv
+        if self.render:
+            envs = gym.vector.SyncVectorEnv([make_env for _ in range(self.n_envs)])
+        else:
+            envs = make_async_envs(self.n_envs)
+        model = DDPGModel(S_DIM, A_DIM)
+        envs.seed(1)
+        running = True
+        while running:
+            s = envs.reset().astype(np.float32)
+            # Pendulum-v0 unwrapped never terminates, episodes are cut at EP_MAXLEN
+            for it in range(EP_MAXLEN):
+                running = self.sync(model)
+                if not running:
+                    break
+                if self.render:
+                    envs.envs[0].render()
+                a = model.choose_action(s)
+                s_next, r, done, info = envs.step(a)
+                s_next = s_next.astype(np.float32)
+                r = (r + 8.0) / 8.0
+                self.buffer.store_batch(s, a, r, s_next)
+                s = s_next
+        envs.close()
+        print(' [*] BufferProcess wid {} reaches the exit!'.format(self.wid))
 
 
 
 class CallbackFunctor(object):
     def __init__(self, logdir):
-        self.writer = tf.summary.FileWriter(logdir, model.sess.graph)
-        self.counter = 0
+        self.writer = tf.summary.FileWriter(logdir, model.sess.graph, flush_secs=60)
 
-    def __call__(self, sums, feed_dict):
-        if self.counter % WRITE_LOGS_EVERY == 5:
-            sumstr = model.sess.run(sums, feed_dict=feed_dict)
-            self.writer.add_summary(sumstr, global_step=self.counter)
-        self.counter += 1
+    def __call__(self, sumstr, global_step):
+        self.writer.add_summary(sumstr, global_step=global_step)
 
 
 
 if __name__ == '__main__':
+    # TensorFlow is not fork-safe, the rollout process starts from a fresh interpreter
+    multiprocessing.set_start_method('spawn')
     if not os.path.exists(LOGDIR):
         os.makedirs(LOGDIR)
     if not os.path.exists(MODEL_DIR):
         os.makedirs(MODEL_DIR)
 
-    model = DDPGModel(S_DIM, A_DIM)
     buffer = MemoryBuffer(CAPACITY, S_DIM, A_DIM)
-    coord = tf.train.Coordinator()
-    _, model.counter = load(model.sess, model_path=MODEL_DIR)
+    init_envs = make_async_envs(N_INIT_ENVS)
+    buffer.init_buffer(init_envs)
+    init_envs.close()
+    model = DDPGModel(S_DIM, A_DIM, buffer=buffer, model_path=MODEL_DIR)
     slim.model_analyzer.analyze_vars(tf.trainable_variables(), print_info=True)
+    conn, child_conn = multiprocessing.Pipe()
 
     class ModelThread(threading.Thread):
         def __init__(self, wid=0):
@@ -209,54 +513,25 @@ if __name__ == '__main__':
         def run(self):
             print(' [*] ModelThread start to run...')
             for it in range(N_ITERS):
-                LOCK.acquire()
-                s, a, r, s_next = buffer.sample(BATCH_SIZE)
-                LOCK.release()
-                model.train(s, a, r, s_next, callback=self.functor)
-            coord.request_stop()
+                model.train(callback=self.functor)
+                if it % SYNC_EVERY == 0:
+                    conn.send((model.get_actor_params(), model.variance))
+            conn.send(None)
             print(' [*] ModelThread wid {} reaches the exit!'.format(self.wid))
 
 
-    class BufferThread(threading.Thread):
-        def __init__(self, wid=1, render=True):
-            self.render = render
-            self.wid = wid
-            self.env = gym.make('Pendulum-v0').unwrapped
-            self.env.seed(1)
-            super(BufferThread, self).__init__()
-            print(' [*] BufferThread {} okay...'.format(wid))
-
-        def run(self):
-            print(' [*] BufferThread start to run...')
-            while not coord.should_stop():
-                s = self.env.reset()
-                for it in range(EP_MAXLEN):
-                    if self.render:
-                        self.env.render()
-                    a = model.choose_action(s)
-                    s_next, r, done, info = self.env.step(a)
-                    r = (r + 8.0) / 8.0
-                    LOCK.acquire()
-                    buffer.store_transition(s, a, r, s_next)
-                    LOCK.release()
-                    s = s_next
-                    if done:
-                        break
-            print(' [*] BufferThread wid {} reaches the exit!'.format(self.wid))
-
-
     model_thread = ModelThread()
-    buffer_thread = BufferThread(render=RENDER)
-    buffer.init_buffer(buffer_thread.env, model)
+    buffer_process = BufferProcess(buffer, child_conn, render=RENDER)
 
+    model.variance = 0.0
+    conn.send((model.get_actor_params(), model.variance))
     if not TEST:
         model_thread.start()
-    #else:
-    model.variance = 0.0
-    buffer_thread.start()
+    buffer_process.start()
     if not TEST:
-        coord.join([model_thread, buffer_thread])
+        model_thread.join()
+        buffer_process.join()
         save(model.sess, MODEL_DIR, model.name, global_step=model.counter)
     else:
-        coord.join([buffer_thread])
+        buffer_process.join()
     print(' [*] The main process reaches the exit!!')
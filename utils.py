@@ -53,13 +53,25 @@ def save(sess, model_path, model_name, global_step, remove_previous_files=True):
     return saved_path
 
 
-def load(sess, model_path):
+def load(sess, model_path, allow_partial=False):
+    """load
+    :param allow_partial: type bool, restore only the variables present in the checkpoint (with a
+        matching shape) and leave the others untouched, e.g. for `initialize_uninitialized`
+    """
     print(" [*] Reading checkpoints...")
-    saver = tf.train.Saver()
     ckpt = tf.train.get_checkpoint_state(model_path)
     if ckpt and ckpt.model_checkpoint_path:
         ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-        saver.restore(sess, os.path.join(model_path, ckpt_name))
+        ckpt_path = os.path.join(model_path, ckpt_name)
+        var_list = None
+        if allow_partial:
+            saved = dict(tf.train.list_variables(ckpt_path))
+            var_list = [v for v in tf.global_variables() if saved.get(v.op.name) == v.shape.as_list()]
+            if len(var_list) == 0:
+                print(" [*] No variable of {} matches the graph".format(ckpt_name))
+                return False, 0
+        saver = tf.train.Saver(var_list=var_list)
+        saver.restore(sess, ckpt_path)
         counter = int(next(re.finditer("(\d+)(?!.*\d)", ckpt_name)).group(0))
         print(" [*] Success to read {}".format(ckpt_name))
         return True, counter
@@ -68,6 +80,18 @@ def load(sess, model_path):
         return False, 0
 
 
+def initialize_uninitialized(sess):
+    """initialize_uninitialized
+    :param sess: type tf.Session
+
+    Initializes only the variables which are still uninitialized, e.g. those not restored by `load`
+    """
+    uninitialized = set(sess.run(tf.report_uninitialized_variables()))
+    var_list = [v for v in tf.global_variables() if v.op.name.encode() in uninitialized]
+    if len(var_list) > 0:
+        sess.run(tf.variables_initializer(var_list))
+
+
 def set_global_seed(seed):
     tf.set_random_seed(seed)
     np.random.seed(seed)